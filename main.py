@@ -1,8 +1,25 @@
 import os
 import time
 import re
-from supabase import create_client, Client
-import requests # Chatwork APIとのHTTP通信用
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import signal
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from itertools import repeat
+import ahocorasick # 顔文字・絵文字の一括検索用
+from supabase import create_client, Client, ClientOptions
+import httpx # Supabaseクライアントの接続プール設定用
+import aiohttp # Chatwork APIとの非同期HTTP通信用
+from fastapi import FastAPI, HTTPException, Request # Chatwork Webhookの受信用
+import uvicorn
 
 # --- 環境変数から設定を読み込む ---
 # Renderの環境変数として設定してください
@@ -11,99 +28,361 @@ CHATWORK_API_TOKEN = os.getenv("CHATWORK_API_TOKEN")
 # 例: "1234567,8901234"
 MONITORED_ROOM_IDS_STR = os.getenv("MONITORED_ROOM_IDS", "") 
 MONITORED_ROOM_IDS = [int(rid.strip()) for rid in MONITORED_ROOM_IDS_STR.split(',') if rid.strip()]
+# Webhookを設定したルームIDと、そのWebhookのトークン (署名検証用)。ChatworkはWebhookごとに別のトークンを発行するため、
+# "ルームID:トークン" をカンマ区切りで指定する。例: "1234567:xxxx,8901234:yyyy"
+# ここに含まれるルームはポーリングせずWebhookのみで処理し、含まれないルームはポーリングで監視する
+WEBHOOK_TOKENS_STR = os.getenv("WEBHOOK_TOKENS", "")
+WEBHOOK_PORT = int(os.getenv("PORT", 8000)) # Webhookを受け付けるポート (RenderのWeb Serviceでは PORT が自動で設定される)
 
 STAMP_EMOJI_THRESHOLD = int(os.getenv("STAMP_EMOJI_THRESHOLD", 30)) # スタンプ・絵文字の閾値
 MENTION_THRESHOLD = int(os.getenv("MENTION_THRESHOLD", 10)) # 個人のメンションの閾値
-COUNT_RESET_INTERVAL_HOURS = int(os.getenv("COUNT_RESET_INTERVAL_HOURS", 24)) # カウントリセット間隔（時間）
+COUNT_RESET_INTERVAL_HOURS = int(os.getenv("COUNT_RESET_INTERVAL_HOURS", 24)) # カウントの集計期間（時間）
 POLLING_INTERVAL_SECONDS = int(os.getenv("POLLING_INTERVAL_SECONDS", 5)) # ポーリング間隔（秒）
+IDLE_POLLING_MAX_SECONDS = int(os.getenv("IDLE_POLLING_MAX_SECONDS", 60)) # 新着がないルームのポーリング間隔の上限（秒）
+ENABLED_ROOMS_CACHE_TTL_SECONDS = int(os.getenv("ENABLED_ROOMS_CACHE_TTL_SECONDS", 60)) # 有効ルーム一覧キャッシュの有効期間（秒）
+MEMBER_REFRESH_BASE_SECONDS = 3600 # メンバーロール情報の基本更新間隔（秒）
+MEMBER_REFRESH_MAX_SECONDS = 6 * 3600 # メンバー構成が変わらない場合に延ばす更新間隔の上限（秒）。RTTによる延長後もこれを超えない
+MEMBER_FORCED_REFRESH_MIN_SECONDS = 60 # 未知の送信者などで即時更新する場合の、同一ルームでの最短間隔（秒）
+STATE_PERSIST_INTERVAL_SECONDS = int(os.getenv("STATE_PERSIST_INTERVAL_SECONDS", 30)) # 状態をSupabaseへまとめて保存する間隔（秒）
+# true の場合、カウントの集計と閾値判定をSupabaseのSQL関数 fn_register_message で行う (sql/fn_register_message.sql)
+SERVER_SIDE_THRESHOLDS = os.getenv("SERVER_SIDE_THRESHOLDS", "false").lower() == "true"
+ACTIVITY_TRACKED_KEYS_MAX = 10000 # アクティビティを保持する (ルーム, ユーザー, 種別) の最大数
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper() # ログレベル (メッセージごとの詳細を出す場合は DEBUG)
 
 # Supabase設定
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY") # Service Role Keyを使用することを強く推奨
 
+# --- ロギング ---
+logger = logging.getLogger("yuzubot")
+# 不明なログレベルが指定された場合は起動を止めず INFO にする
+logger.setLevel(LOG_LEVEL if isinstance(logging.getLevelName(LOG_LEVEL), int) else logging.INFO)
+
+def setup_logging():
+    """ログをキュー経由で別スレッドから標準エラーへ出力するリスナーを設定して返す"""
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.propagate = False
+    if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+        logger.warning("不明なLOG_LEVEL '%s' が指定されたため、INFO で出力します。", LOG_LEVEL)
+    return logging.handlers.QueueListener(log_queue, stream_handler)
+
 # --- Chatwork APIクライアント ---
 class ChatworkApiClient:
     def __init__(self, token):
         self.base_url = "https://api.chatwork.com/v2"
         self.headers = {"X-ChatWorkToken": token}
-
-    def _request(self, method, endpoint, **kwargs):
-        """汎用リクエストメソッド"""
+        self._session = None # get_session() で初回利用時に生成し、以降は使い回す
+        self._validators = {} # {endpoint: {"If-None-Match": etag, "If-Modified-Since": last_modified}}
+        self._message_rtts = deque(maxlen=3) # 直近3回の get_messages 成功時のRTT（秒）
+
+    def get_session(self):
+        """共有のaiohttpセッションを取得 (Keep-AliveでTCP/TLS接続を再利用する)"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=50, keepalive_timeout=75)
+            self._session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        return self._session
+
+    async def close(self):
+        """セッションを閉じる"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _request(self, method, endpoint, **kwargs):
+        """汎用リクエストメソッド (GETは前回のETag/Last-Modifiedを付けた条件付きリクエストにする)"""
         url = f"{self.base_url}{endpoint}"
+        if method == "GET" and endpoint in self._validators:
+            kwargs["headers"] = {**self._validators[endpoint], **kwargs.get("headers", {})}
         try:
-            response = requests.request(method, url, headers=self.headers, **kwargs)
-            response.raise_for_status() # HTTPエラーがあれば例外を発生させる
-            return response.json()
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTPエラーが発生しました: {http_err} - レスポンス: {response.text}")
+            async with self.get_session().request(method, url, **kwargs) as response:
+                if response.status >= 400:
+                    logger.error("HTTPエラーが発生しました: %s %s - レスポンス: %s", response.status, response.reason, await response.text())
+                response.raise_for_status() # HTTPエラーがあれば例外を発生させる
+                if response.status in (204, 304): # 新着メッセージなし・前回から変更なしなど、本文が空のレスポンス
+                    return None
+                if method == "GET":
+                    validators = {}
+                    if "ETag" in response.headers:
+                        validators["If-None-Match"] = response.headers["ETag"]
+                    if "Last-Modified" in response.headers:
+                        validators["If-Modified-Since"] = response.headers["Last-Modified"]
+                    if validators:
+                        self._validators[endpoint] = validators
+                return await response.json()
+        except aiohttp.ClientResponseError:
             raise
-        except requests.exceptions.ConnectionError as conn_err:
-            print(f"接続エラーが発生しました: {conn_err}")
+        except aiohttp.ClientConnectionError as conn_err:
+            logger.error("接続エラーが発生しました: %s", conn_err)
             raise
-        except requests.exceptions.Timeout as timeout_err:
-            print(f"タイムアウトエラーが発生しました: {timeout_err}")
+        except asyncio.TimeoutError as timeout_err:
+            logger.error("タイムアウトエラーが発生しました: %s", timeout_err)
             raise
-        except requests.exceptions.RequestException as req_err:
-            print(f"リクエストエラーが発生しました: {req_err}")
+        except aiohttp.ClientError as req_err:
+            logger.error("リクエストエラーが発生しました: %s", req_err)
             raise
 
-    def get_my_rooms(self):
+    async def get_my_rooms(self):
         """ボットが参加しているルームの一覧を取得"""
-        return self._request("GET", "/my/rooms")
+        return await self._request("GET", "/my/rooms")
 
-    def get_messages(self, room_id, last_id=0):
-        """指定ルームのメッセージを取得"""
+    async def get_messages(self, room_id, last_id=0):
+        """指定ルームのメッセージを取得 (変更がない場合はNone)"""
         params = {"last_id": last_id}
-        return self._request("GET", f"/rooms/{room_id}/messages", params=params)
-
-    def get_room_members(self, room_id):
-        """指定ルームのメンバー情報を取得"""
-        return self._request("GET", f"/rooms/{room_id}/members")
-
-    def change_user_permission(self, room_id, account_id, new_role):
+        started_at = time.monotonic()
+        messages = await self._request("GET", f"/rooms/{room_id}/messages", params=params)
+        self._message_rtts.append(time.monotonic() - started_at)
+        return messages
+
+    async def get_room_members(self, room_id):
+        """指定ルームのメンバー情報を取得 (前回から変更がない場合はNone)"""
+        return await self._request("GET", f"/rooms/{room_id}/members")
+
+    def rtt_multiplier(self):
+        """直近の get_messages のRTTに応じた待機間隔の倍率を返す (高速回線: 1倍 〜 低速回線: 10倍)"""
+        if not self._message_rtts:
+            return 1
+        average_rtt = sum(self._message_rtts) / len(self._message_rtts)
+        if average_rtt < 0.5:
+            return 1
+        if average_rtt < 1.0:
+            return 2
+        if average_rtt < 2.0:
+            return 5
+        return 10
+
+    async def change_user_permission(self, room_id, account_id, new_role):
         """ユーザーのルーム権限を変更"""
         # Chatwork APIの/rooms/{room_id}/members APIは、部屋のメンバーリスト全体をPUTで送信して更新する形式です。
         # 現在のメンバーリストを取得し、対象ユーザーのロールのみを変更して、再度PUTする必要があります。
         # NOTE: この実装は簡略化されており、実際の運用ではより堅牢なメンバー管理ロジックが必要です。
-        print(f"【APIコール】ユーザー {account_id} の権限を '{new_role}' に変更します (ルームID: {room_id})")
+        logger.warning("【APIコール】ユーザー %s の権限を '%s' に変更します (ルームID: %s)", account_id, new_role, room_id)
         
         # 簡易的な実装: 権限変更は実際にはこのメソッド内でPUTリクエストを実行します。
         # 例:
-        # current_members = self.get_room_members(room_id)
+        # current_members = await self.get_room_members(room_id)
         # updated_members = []
         # for member in current_members:
         #     if member['account_id'] == account_id:
         #         member['role'] = new_role
         #     updated_members.append({"account_id": member['account_id'], "role": member['role']})
-        # return self._request("PUT", f"/rooms/{room_id}/members", json={"members": updated_members})
+        # return await self._request("PUT", f"/rooms/{room_id}/members", json={"members": updated_members})
         
         # 実際には上記のようにPUTリクエストを送信する必要がありますが、
         # サンプルとしてTrueを返しておきます。
         # 本番運用時は必ずChatwork APIの仕様に合わせて実装してください。
         # 非常に重要な操作のため、慎重な実装とテストが必要です。
-        print(f"  -> Chatwork APIの権限変更PUTリクエストはダミーです。実際に実装してください。")
+        logger.warning("  -> Chatwork APIの権限変更PUTリクエストはダミーです。実際に実装してください。")
         return True 
 
-    def post_message(self, room_id, message_body):
+    async def post_message(self, room_id, message_body):
         """指定ルームにメッセージを投稿"""
         data = {"body": message_body}
-        return self._request("POST", f"/rooms/{room_id}/messages", data=data)
+        return await self._request("POST", f"/rooms/{room_id}/messages", data=data)
 
 # --- Supabaseクライアントの初期化 ---
 def init_supabase_client():
     if not SUPABASE_URL or not SUPABASE_KEY:
-        print("SupabaseのURLまたはキーが設定されていません。")
+        logger.error("SupabaseのURLまたはキーが設定されていません。")
         return None
     try:
-        supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+        # 接続プールの上限とタイムアウトを明示したhttpxクライアントを使う (リダイレクト追従・HTTP/2はpostgrestの既定と同じ)
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            timeout=10,
+            follow_redirects=True,
+            http2=True,
+        )
+        supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=http_client))
         # Supabaseとの接続テスト
         # 例: supabase.from_("roomid").select("room_id_column").limit(1).execute()
-        print("Supabaseクライアントを正常に初期化しました。")
+        logger.info("Supabaseクライアントを正常に初期化しました。")
         return supabase
     except Exception as e:
-        print(f"Supabaseクライアントの初期化に失敗しました: {e}")
+        logger.error("Supabaseクライアントの初期化に失敗しました: %s", e)
         return None
 
+def retry_db(fn, tries=3):
+    """Supabaseへの呼び出しを、接続エラー時にジッター付きの指数バックオフで再試行"""
+    for attempt in range(tries):
+        try:
+            return fn()
+        except (httpx.PoolTimeout, httpx.ConnectError) as e:
+            if attempt == tries - 1:
+                raise
+            wait_seconds = 2 ** attempt + random.random()
+            logger.warning("Supabaseへの接続に失敗しました: %s (%.1f秒後に再試行 %s/%s)", e, wait_seconds, attempt + 1, tries - 1)
+            time.sleep(wait_seconds)
+
+# 有効化されたルームIDのキャッシュ。TTL切れ時のみSupabaseから再取得し、
+# `/command OK`・`/command NO` の実行時はローカルで即座に更新する
+# "set" は常に同じsetオブジェクトをイベントループ上で更新し、"local_changes" には再取得中に行われたローカルの変更を記録する
+_enabled_rooms_cache = {"set": set(), "ts": 0.0, "local_changes": {}}
+
+def fetch_enabled_rooms(supabase_client):
+    """Supabaseに登録されている、ボットが反応すべきルームIDの一覧を取得"""
+    # Supabaseのテーブル名が 'roomid' で、room_idが 'room_id_column' に保存されていると仮定
+    enabled_rooms_data = retry_db(lambda: supabase_client.from_("roomid").select("room_id_column").execute()).data
+    return {int(row['room_id_column']) for row in enabled_rooms_data}
+
+async def refresh_enabled_rooms(supabase_client, current_time):
+    """ルームIDの一覧を再取得してキャッシュを更新
+
+    取得中に `/command OK`・`/command NO` で変更されたルームは、取得結果が古い可能性があるため、取得結果の反映後に再適用する
+    """
+    local_changes = _enabled_rooms_cache["local_changes"] = {}
+    enabled_room_ids = await asyncio.to_thread(fetch_enabled_rooms, supabase_client)
+    cached_room_ids = _enabled_rooms_cache["set"]
+    cached_room_ids.clear()
+    cached_room_ids.update(enabled_room_ids)
+    for room_id, enabled in local_changes.items():
+        if enabled:
+            cached_room_ids.add(room_id)
+        else:
+            cached_room_ids.discard(room_id)
+    _enabled_rooms_cache["ts"] = current_time
+
+def set_room_enabled(room_id, enabled):
+    """`/command OK`・`/command NO` によるSupabaseへの書き込み後に、キャッシュをローカルで更新"""
+    if enabled:
+        _enabled_rooms_cache["set"].add(room_id)
+    else:
+        _enabled_rooms_cache["set"].discard(room_id)
+    _enabled_rooms_cache["local_changes"][room_id] = enabled
+
+# fn_register_message が返す判定結果と、権限変更通知に表示する理由
+SERVER_VERDICT_REASONS = {'toall': "[toall] ", 'stamps': "スタンプ・絵文字", 'mentions': "個人メンション"}
+
+# ルームごとの状態。ループ内で毎回参照されるため、辞書ではなく __slots__ のクラスで保持する
+class _RoomPollState:
+    """ルームごとの最終メッセージID・次回ポーリング時刻・現在のポーリング間隔"""
+    __slots__ = ("last_id", "next_poll", "backoff")
+
+    def __init__(self, backoff):
+        self.last_id = 0
+        self.next_poll = 0.0
+        self.backoff = backoff
+
+class _MemberRefreshState:
+    """ルームごとのメンバー構成のハッシュと、次回のメンバー情報更新までの秒数"""
+    __slots__ = ("hash", "interval")
+
+    def __init__(self):
+        self.hash = None
+        self.interval = MEMBER_REFRESH_BASE_SECONDS
+
+# --- 状態の永続化 ---
+# 最終メッセージIDは 'room_state' テーブル (room_id, last_message_id)、
+# アクティビティは 'activity' テーブル (room_id, account_id, metric, timestamps) に保存すると仮定
+SUPABASE_PAGE_SIZE = 1000 # 1回のselectで要求する行数
+
+def select_all_rows(build_query):
+    """build_query() で組み立てたselectを、SUPABASE_PAGE_SIZE 行ずつページングして全行取得
+
+    プロジェクトの "Max rows" 設定がページサイズより小さいと1ページ目から行数が不足するため、
+    空のページが返るまで、実際に取得できた行数分ずつ読み進める
+    """
+    rows = []
+    while True:
+        page = retry_db(lambda: build_query().range(len(rows), len(rows) + SUPABASE_PAGE_SIZE - 1).execute()).data
+        if not page:
+            return rows
+        rows.extend(page)
+
+def load_persisted_state(supabase_client, room_poll_state, user_activity_events, current_time):
+    """Supabaseに保存された最終メッセージIDとアクティビティを復元"""
+    for row in select_all_rows(lambda: supabase_client.from_("room_state").select("room_id, last_message_id").order("room_id")):
+        room_id = int(row['room_id'])
+        if room_id in room_poll_state:
+            room_poll_state[room_id].last_id = row['last_message_id']
+
+    # 集計期間を過ぎたアクティビティは削除し、残りは古い順に読み込んでLRUの順序を再現する
+    window_start = current_time - COUNT_RESET_INTERVAL_HOURS * 3600
+    retry_db(lambda: supabase_client.from_("activity").delete().lt("last_event_at", window_start).execute())
+    maxlen_per_metric = {'stamps': STAMP_EMOJI_THRESHOLD + 1, 'mentions': MENTION_THRESHOLD + 1}
+    activity_rows = select_all_rows(lambda: supabase_client.from_("activity")
+                                    .select("room_id, account_id, metric, timestamps")
+                                    .gte("last_event_at", window_start)
+                                    .order("last_event_at").order("room_id").order("account_id").order("metric"))
+    for row in activity_rows:
+        if row['metric'] not in maxlen_per_metric:
+            continue
+        timestamps = [timestamp for timestamp in row['timestamps'] or () if timestamp >= window_start]
+        if timestamps:
+            key = (int(row['room_id']), int(row['account_id']), row['metric'])
+            user_activity_events[key] = deque(timestamps, maxlen=maxlen_per_metric[row['metric']])
+    while len(user_activity_events) > ACTIVITY_TRACKED_KEYS_MAX:
+        user_activity_events.popitem(last=False)
+
+def save_state(supabase_client, room_rows, activity_rows, deleted_activity_keys):
+    """変更のあった最終メッセージIDとアクティビティを、テーブルごとに1回のupsertでまとめて保存
+
+    カウントが空になった・メモリ上から破棄された (room_id, user_id, 種別) の行は削除する
+    """
+    if room_rows:
+        retry_db(lambda: supabase_client.from_("room_state").upsert(room_rows, on_conflict="room_id").execute())
+    if activity_rows:
+        retry_db(lambda: supabase_client.from_("activity").upsert(activity_rows, on_conflict="room_id,account_id,metric").execute())
+    deleted_activity_keys = list(deleted_activity_keys)
+    for offset in range(0, len(deleted_activity_keys), 100): # URLが長くなりすぎないよう100件ずつ
+        conditions = ",".join(f"and(room_id.eq.{room_id},account_id.eq.{account_id},metric.eq.{metric})" for room_id, account_id, metric in deleted_activity_keys[offset:offset + 100])
+        retry_db(lambda: supabase_client.from_("activity").delete().or_(conditions).execute())
+
+# --- Webhook受信 ---
+def parse_webhook_tokens(webhook_tokens_str):
+    """'ルームID:トークン' のカンマ区切り文字列を {room_id: 署名検証用の鍵 (トークンをBase64デコードしたもの)} に変換"""
+    webhook_keys = {}
+    for entry in webhook_tokens_str.split(','):
+        if not entry.strip():
+            continue
+        room_id_str, _, token = entry.partition(':')
+        try:
+            if not token.strip():
+                raise ValueError("empty token")
+            webhook_keys[int(room_id_str.strip())] = base64.b64decode(token.strip(), validate=True)
+        except ValueError as e:
+            raise ValueError(f"WEBHOOK_TOKENS の形式が不正です ('ルームID:トークン' で指定してください): {room_id_str.strip()}") from e
+    return webhook_keys
+
+# 起動時に一度だけデコードし、設定が不正な場合はここで終了する
+WEBHOOK_KEYS = parse_webhook_tokens(WEBHOOK_TOKENS_STR)
+WEBHOOK_ROOM_IDS = set(WEBHOOK_KEYS)
+
+def verify_webhook_signature(webhook_key, request_body, signature):
+    """リクエスト本文のHMAC-SHA256署名が、ルームのWebhookトークンから計算したものと一致するかを検証"""
+    if not signature:
+        return False
+    digest = hmac.new(webhook_key, request_body, hashlib.sha256).digest()
+    # 非ASCII文字を含む文字列同士は compare_digest で比較できない (TypeError になる) ため、bytesに変換して比較する
+    return hmac.compare_digest(base64.b64encode(digest), signature.encode("utf-8"))
+
+def create_webhook_app(on_message):
+    """Chatworkのmessage_createdイベントを受け取り、on_message に渡すFastAPIアプリを生成"""
+    app = FastAPI()
+
+    @app.post("/webhook")
+    async def webhook(request: Request):
+        request_body = await request.body()
+        signature = request.headers.get("X-ChatWorkWebhookSignature") or request.query_params.get("chatwork_webhook_signature")
+        # 署名の検証に使うトークンはルームごとに異なるため、先に本文からルームIDを取り出す
+        try:
+            payload = json.loads(request_body)
+            room_id = int(payload["webhook_event"]["room_id"])
+        except (ValueError, TypeError, KeyError):
+            logger.warning("本文を解釈できないWebhookリクエストを破棄しました。")
+            raise HTTPException(status_code=400, detail="invalid body")
+        webhook_key = WEBHOOK_KEYS.get(room_id)
+        if webhook_key is None or not verify_webhook_signature(webhook_key, request_body, signature):
+            logger.warning("署名が一致しないWebhookリクエストを破棄しました (ルームID: %s)。", room_id)
+            raise HTTPException(status_code=401, detail="invalid signature")
+        if payload.get("webhook_event_type") == "message_created":
+            await on_message(payload["webhook_event"])
+        return {"status": "ok"}
+
+    return app
+
 # --- ヘルパー関数 ---
 # Chatworkの顔文字・絵文字リスト (提供いただいたもの)
 ALL_EMOTICONS = [
@@ -115,184 +394,428 @@ ALL_EMOTICONS = [
     "(F)", "(cracker)", "(eat)", "(^)", "(coffee)", "(beer)", "(handshake)", "(y)"
 ]
 
-def count_emoticons_in_message(message_body, emoticon_list):
-    """メッセージ本文に含まれる顔文字・絵文字・Chatworkスタンプの数をカウント"""
-    count = 0
-    for emoticon in emoticon_list:
-        count += message_body.count(emoticon)
-    # Chatworkの標準スタンプ形式もカウント
-    count += len(re.findall(r"\[STAMP:\d+\]", message_body))
-    return count
-
-def count_personal_mentions(message_body):
-    """メッセージ本文に含まれる個人のメンション数をカウント"""
-    return len(re.findall(r"\[To:\d+\]", message_body))
+# 全ての顔文字・絵文字を1つのAho-Corasickオートマトンにまとめ、本文を1回走査するだけで数えられるようにする
+_EMOTICON_AUTOMATON = ahocorasick.Automaton()
+for _emoticon in ALL_EMOTICONS:
+    _EMOTICON_AUTOMATON.add_word(_emoticon, _emoticon)
+_EMOTICON_AUTOMATON.make_automaton()
+
+# 顔文字・絵文字の先頭文字。いずれも '[' も含まない本文はマークアップなしとして走査を省略できる
+_EMO_TRIGGERS = frozenset(emoticon[0] for emoticon in ALL_EMOTICONS)
+
+def has_markup(message_body):
+    """スタンプ・メンション・顔文字などを含む可能性があるかを高速に判定"""
+    return "[" in message_body or not _EMO_TRIGGERS.isdisjoint(message_body)
+
+# スタンプ・個人メンション・[toall] を1つのパターンにまとめ、本文を1回走査するだけで判定する
+_MARKUP_RE = re.compile(r"\[STAMP:\d+\]|\[To:\d+\]|\[toall\]")
+
+def count_emoticons_in_message(message_body):
+    """メッセージ本文に含まれる顔文字・絵文字の数をカウント (Chatworkスタンプは scan_markup で数える)"""
+    return sum(1 for _ in _EMOTICON_AUTOMATON.iter(message_body))
+
+def _tally_markup(text, body_starts):
+    """text 内のChatworkスタンプ数・個人メンション数・[toall]の有無を、body_starts (各本文の開始位置) で区切られた本文ごとに数える"""
+    stamps = [0] * len(body_starts)
+    mentions = [0] * len(body_starts)
+    has_toall = [False] * len(body_starts)
+    for match in _MARKUP_RE.finditer(text):
+        index = bisect_right(body_starts, match.start()) - 1
+        kind = match.group(0)[1] # '[' の次の文字で種類を判別: 'S'=STAMP, 'T'=To, 't'=toall
+        if kind == 'S':
+            stamps[index] += 1
+        elif kind == 'T':
+            mentions[index] += 1
+        else:
+            has_toall[index] = True
+    return stamps, mentions, has_toall
+
+def scan_markup(message_body):
+    """メッセージ本文のChatworkスタンプ数・個人メンション数・[toall]の有無を返す"""
+    stamps, mentions, has_toall = _tally_markup(message_body, [0])
+    return stamps[0], mentions[0], has_toall[0]
+
+def record_activity(activity_events, key, count, current_time, maxlen, evicted_keys=None):
+    """(room_id, user_id, 種別) ごとに発生時刻を記録し、直近 COUNT_RESET_INTERVAL_HOURS 時間の件数を返す
+
+    上限超過で破棄したキーは evicted_keys に追加する
+    """
+    events = activity_events.get(key)
+    if events is None:
+        if count == 0:
+            return 0
+        # 閾値判定には閾値+1件まで保持すれば十分なため、ユーザーごとのメモリ使用量は一定
+        events = activity_events[key] = deque(maxlen=maxlen)
+    activity_events.move_to_end(key)
+    events.extend(repeat(current_time, min(count, maxlen)))
+
+    # スライディングウィンドウの外に出た古い記録を破棄
+    window_start = current_time - COUNT_RESET_INTERVAL_HOURS * 3600
+    while events and events[0] < window_start:
+        events.popleft()
+
+    # 最も長く活動のないものから破棄し、全体のメモリ使用量にも上限を設ける
+    while len(activity_events) > ACTIVITY_TRACKED_KEYS_MAX:
+        evicted_key, _ = activity_events.popitem(last=False)
+        if evicted_keys is not None:
+            evicted_keys.add(evicted_key)
+    return len(events)
+
+# 複数メッセージの本文を連結する際の区切り文字。どの検出パターンにも含まれないため、区切りをまたいで一致することはない
+_MESSAGE_SEPARATOR = "\x1f"
+
+def scan_messages(message_bodies):
+    """複数のメッセージ本文を連結して一括で走査し、本文ごとの
+    (顔文字・絵文字数, スタンプ数, 個人メンション数, [toall]の有無) のリストを返す"""
+    joined_body = _MESSAGE_SEPARATOR.join(message_bodies)
+    # 各本文の連結後の開始位置。一致した位置から bisect で何件目の本文かを求める
+    body_starts = []
+    offset = 0
+    for message_body in message_bodies:
+        body_starts.append(offset)
+        offset += len(message_body) + len(_MESSAGE_SEPARATOR)
+
+    emoticons = [0] * len(message_bodies)
+    for end_index, _ in _EMOTICON_AUTOMATON.iter(joined_body):
+        emoticons[bisect_right(body_starts, end_index) - 1] += 1
+    stamps, mentions, has_toall = _tally_markup(joined_body, body_starts)
+    return list(zip(emoticons, stamps, mentions, has_toall))
 
 # --- メインロジック ---
-def run_bot():
+async def run_bot():
     chatwork_api = ChatworkApiClient(CHATWORK_API_TOKEN)
     supabase_client: Client = init_supabase_client()
 
     if not CHATWORK_API_TOKEN:
-        print("エラー: CHATWORK_API_TOKENが設定されていません。")
+        logger.error("エラー: CHATWORK_API_TOKENが設定されていません。")
         return
     if not supabase_client:
-        print("エラー: Supabaseクライアントの初期化に失敗しました。ボットを終了します。")
+        logger.error("エラー: Supabaseクライアントの初期化に失敗しました。ボットを終了します。")
         return
     if not MONITORED_ROOM_IDS:
-        print("警告: MONITORED_ROOM_IDSが設定されていません。ボットが反応するルームがありません。")
+        logger.warning("警告: MONITORED_ROOM_IDSが設定されていません。ボットが反応するルームがありません。")
         # ボットが参加している全てのルームを取得し、それを監視対象とするロジックを追加することも可能
-        # 例: MONITORED_ROOM_IDS = [room['room_id'] for room in chatwork_api.get_my_rooms()]
+        # 例: MONITORED_ROOM_IDS = [room['room_id'] for room in await chatwork_api.get_my_rooms()]
 
-    last_message_id_per_room = {room_id: 0 for room_id in MONITORED_ROOM_IDS} # 各ルームごとの最終メッセージID
+    # Webhookで受け取れるルームはポーリングせず、それ以外のルームのみポーリングで補う
+    polling_room_ids = [room_id for room_id in MONITORED_ROOM_IDS if room_id not in WEBHOOK_ROOM_IDS]
+    # 各ルームごとの最終メッセージID・次回ポーリング時刻・現在のポーリング間隔
+    room_poll_state = {room_id: _RoomPollState(POLLING_INTERVAL_SECONDS) for room_id in polling_room_ids}
     user_roles_per_room = {} # {room_id: {account_id: role, 'last_update_time': timestamp}, ...}
-    user_activity_counts = {} # {room_id: {user_id: {'stamps': N, 'mentions': M, 'last_reset_time': timestamp}, ...}, ...}
-
-    print("Chatwork Botを開始します...")
+    member_refresh_state = {} # {room_id: _MemberRefreshState, ...}
+    user_activity_events = OrderedDict() # {(room_id, user_id, 'stamps' | 'mentions'): deque([timestamp, ...]), ...} (LRU順)
+    dirty_room_ids = set() # 前回の保存以降に最終メッセージIDが進んだルーム
+    dirty_activity_keys = set() # 前回の保存以降に変更のあった (room_id, user_id, 種別)
+    # 権限変更済みの {(room_id, account_id): 権限変更した時刻}。ポーリングの待機時間はルームのバックオフによって変わり、
+    # Webhookはポーリングと無関係に届くため、サイクル単位ではなく POLLING_INTERVAL_SECONDS の間だけ同じユーザーへの重複実行を抑止する
+    pending_actions = {}
 
-    while True:
+    try:
+        await asyncio.to_thread(load_persisted_state, supabase_client, room_poll_state, user_activity_events, time.time())
+        logger.info("Supabaseから前回の状態を復元しました。")
+    except Exception as e:
+        logger.error("Supabaseからの状態の復元に失敗しました: %s", e)
+
+    async def flush_state():
+        """変更のあった状態をSupabaseへまとめて保存"""
+        room_ids, activity_keys = set(dirty_room_ids), set(dirty_activity_keys)
+        dirty_room_ids.clear()
+        dirty_activity_keys.clear()
+        room_rows = [{"room_id": room_id, "last_message_id": room_poll_state[room_id].last_id} for room_id in room_ids]
+        activity_rows = []
+        deleted_activity_keys = []
+        for key in activity_keys:
+            events = user_activity_events.get(key)
+            if events:
+                activity_rows.append({"room_id": key[0], "account_id": key[1], "metric": key[2], "timestamps": list(events), "last_event_at": events[-1]})
+            else:
+                deleted_activity_keys.append(key)
+        if not room_rows and not activity_rows and not deleted_activity_keys:
+            return
         try:
-            current_time = time.time()
-
-            # Supabaseに登録されている、ボットが反応すべきルームIDのリストを取得
-            # Supabaseのテーブル名が 'roomid' で、room_idが 'room_id_column' に保存されていると仮定
-            enabled_rooms_data = supabase_client.from_("roomid").select("room_id_column").execute().data
-            enabled_room_ids = {row['room_id_column'] for row in enabled_rooms_data}
-            
-            # 監視対象の各ルームをループ
-            for room_id in MONITORED_ROOM_IDS:
-                # ルームメンバーのロールを定期的に更新 (例: 1時間ごと)
-                if room_id not in user_roles_per_room or \
-                   (current_time - user_roles_per_room[room_id].get('last_update_time', 0)) / 3600 >= 1: # 1時間以上経過
-                    try:
-                        members_data = chatwork_api.get_room_members(room_id)
-                        user_roles_per_room[room_id] = {member['account_id']: member['role'] for member in members_data}
-                        user_roles_per_room[room_id]['last_update_time'] = current_time
-                        print(f"ルーム {room_id} のメンバーロール情報を更新しました。")
-                    except Exception as e:
-                        print(f"ルーム {room_id} のメンバーロール取得に失敗しました: {e}")
-                        continue # このルームの処理はスキップ
-
-                current_room_last_message_id = last_message_id_per_room.get(room_id, 0)
+            await asyncio.to_thread(save_state, supabase_client, room_rows, activity_rows, deleted_activity_keys)
+        except Exception as e:
+            logger.error("Supabaseへの状態の保存に失敗しました: %s", e)
+            # 次回の保存で再試行する
+            dirty_room_ids.update(room_ids)
+            dirty_activity_keys.update(activity_keys)
+
+    async def persist_state_periodically():
+        while True:
+            await asyncio.sleep(STATE_PERSIST_INTERVAL_SECONDS)
+            await flush_state()
+
+    async def restrict_user(room_id, sender_id, reason):
+        """ユーザーの権限を閲覧のみに変更して通知 (POLLING_INTERVAL_SECONDS 以内の同じユーザーへの重複実行はしない)"""
+        # 権限変更したら、別の閾値で再度反応しないようスタンプ・メンションのカウントをまとめてリセット
+        for metric in ('stamps', 'mentions'):
+            key = (room_id, sender_id, metric)
+            if user_activity_events.get(key):
+                user_activity_events[key].clear()
+                dirty_activity_keys.add(key)
+        current_time = time.time()
+        for action_key, action_time in list(pending_actions.items()):
+            if current_time - action_time >= POLLING_INTERVAL_SECONDS:
+                del pending_actions[action_key]
+        if (room_id, sender_id) in pending_actions:
+            logger.debug("ユーザー %s は直近%s秒以内に権限変更済みのため、%sによる権限変更をスキップします。", sender_id, POLLING_INTERVAL_SECONDS, reason)
+            return
+        pending_actions[(room_id, sender_id)] = current_time
+        logger.warning("【アクション】ユーザー %s の%sの多用を確認しました。権限を閲覧のみに変更します (ルームID: %s)。", sender_id, reason, room_id)
+        await chatwork_api.change_user_permission(room_id, sender_id, 'readonly')
+        await chatwork_api.post_message(room_id, f"[info][title]権限変更通知[/title][To:{sender_id}] さん、{reason}の多用を確認したため、この部屋でのあなたの権限を『閲覧のみ』に変更しました。[/info]")
+
+    async def refresh_room_members(room_id, current_time, force=False):
+        """ルームメンバーのロール情報を必要に応じて更新。取得に失敗した場合はFalseを返す
+
+        force=True の場合は更新間隔のバックオフを無視する (ただし MEMBER_FORCED_REFRESH_MIN_SECONDS に1回まで)
+        """
+        # ルームメンバーのロールを定期的に更新 (基本1時間ごと。メンバー構成に変化がなければ間隔を倍々に延ばし、
+        # 回線が遅い場合はRTTに応じてさらに間隔を延ばす。いずれも MEMBER_REFRESH_MAX_SECONDS が上限)
+        refresh_state = member_refresh_state.get(room_id)
+        if refresh_state is None:
+            refresh_state = member_refresh_state[room_id] = _MemberRefreshState()
+        if room_id in user_roles_per_room:
+            elapsed = current_time - user_roles_per_room[room_id].get('last_update_time', 0)
+            refresh_interval = MEMBER_FORCED_REFRESH_MIN_SECONDS if force else min(refresh_state.interval * chatwork_api.rtt_multiplier(), MEMBER_REFRESH_MAX_SECONDS)
+        if room_id not in user_roles_per_room or elapsed >= refresh_interval:
+            try:
+                members_data = await chatwork_api.get_room_members(room_id)
+                if members_data is None and room_id in user_roles_per_room: # 304: 前回から変更なし
+                    members_hash = refresh_state.hash
+                else:
+                    members_data = members_data or []
+                    members_hash = hashlib.sha256(repr(sorted((member['account_id'], member['role']) for member in members_data)).encode()).hexdigest()
+                    user_roles_per_room[room_id] = {member['account_id']: member['role'] for member in members_data}
+
+                if members_hash == refresh_state.hash:
+                    refresh_state.interval = min(refresh_state.interval * 2, MEMBER_REFRESH_MAX_SECONDS)
+                else:
+                    refresh_state.interval = MEMBER_REFRESH_BASE_SECONDS
+                    refresh_state.hash = members_hash
+                    logger.info("ルーム %s のメンバーロール情報を更新しました。", room_id)
+                user_roles_per_room[room_id]['last_update_time'] = current_time
+            except Exception as e:
+                logger.error("ルーム %s のメンバーロール取得に失敗しました: %s", room_id, e)
+                return False
+        return True
+
+    async def handle_message(room_id, message, current_time, scan=None):
+        """1件のメッセージに対するコマンド処理・監視処理 (ポーリングとWebhookの両方から呼ばれる)
+
+        scan には scan_messages で走査済みの結果を渡せる。省略した場合はこのメッセージだけを走査する
+        """
+        sender_id = message['account_id']
+        message_body = message['body']
+
+        # ボット自身の投稿は無視する
+        # NOTE: ボット自身のaccount_idを取得するChatwork APIは直接提供されていないため、
+        # 環境変数などでボットのaccount_idを設定するか、送信者ロールが'bot'であるかをチェックするなどの工夫が必要
+        # ここでは簡易的にスキップ
+        # if sender_id == YOUR_BOT_ACCOUNT_ID: return
+
+        # キャッシュにない送信者 (前回の更新以降に参加した可能性がある) や、管理者でない送信者のコマンド
+        # (前回の更新以降に管理者になった可能性がある) は、バックオフを無視してメンバー情報を再取得する
+        is_command = message_body.strip() in ("/command OK", "/command NO")
+        cached_role = user_roles_per_room[room_id].get(sender_id)
+        if cached_role is None or (is_command and cached_role != 'admin'):
+            await refresh_room_members(room_id, current_time, force=True)
+        sender_role = user_roles_per_room[room_id].get(sender_id, 'unknown')
+
+        logger.debug("--- ルーム %s 新しいメッセージ --- 送信者ID: %s, ロール: %s, 本文: %s", room_id, sender_id, sender_role, message_body)
+
+        # 1. コマンド処理 (`/command OK`, `/command NO`)
+        if message_body.strip() == "/command OK":
+            if sender_role == 'admin':
+                try:
+                    # 既に登録済みの場合は何もしないupsertにし、返ってきた行数で新規登録かどうかを判定する
+                    inserted_rows = (await asyncio.to_thread(retry_db, lambda: supabase_client.from_("roomid").upsert({"room_id_column": room_id}, on_conflict="room_id_column", ignore_duplicates=True).execute())).data
+                    set_room_enabled(room_id, True)
+                    if inserted_rows:
+                        await chatwork_api.post_message(room_id, "[info][title]ボット有効化[/title]この部屋でのボットの監視を有効にしました。[/info]")
+                        logger.info("ルーム %s をSupabaseに追加しました。", room_id)
+                    else:
+                        await chatwork_api.post_message(room_id, "[info][title]既に有効[/title]この部屋は既にボットの監視が有効です。[/info]")
+                except Exception as e:
+                    logger.error("Supabaseへのルーム有効化でエラー: %s", e)
+                    await chatwork_api.post_message(room_id, "[error][title]エラー[/title]ボットの有効化に失敗しました。[/error]")
+            else:
+                await chatwork_api.post_message(room_id, "[info][title]権限エラー[/title]このコマンドは管理者のみ実行できます。[/info]")
+            # コマンド処理後は、現在のメッセージでの他の監視はスキップ
+            return
+
+        elif message_body.strip() == "/command NO":
+            if sender_role == 'admin':
                 try:
-                    new_messages = chatwork_api.get_messages(room_id, current_room_last_message_id)
+                    await asyncio.to_thread(retry_db, lambda: supabase_client.from_("roomid").delete().eq("room_id_column", room_id).execute())
+                    set_room_enabled(room_id, False)
+                    await chatwork_api.post_message(room_id, "[info][title]ボット無効化[/title]この部屋でのボットの監視を無効にしました。[/info]")
+                    logger.info("ルーム %s をSupabaseから削除しました。", room_id)
                 except Exception as e:
-                    print(f"ルーム {room_id} のメッセージ取得に失敗しました: {e}")
-                    continue # このルームの処理はスキップ
-
-                if new_messages:
-                    for message in new_messages:
-                        sender_id = message['account_id']
-                        message_body = message['body']
-                        
-                        # ボット自身の投稿は無視する
-                        # NOTE: ボット自身のaccount_idを取得するChatwork APIは直接提供されていないため、
-                        # 環境変数などでボットのaccount_idを設定するか、送信者ロールが'bot'であるかをチェックするなどの工夫が必要
-                        # ここでは簡易的にスキップ
-                        # if sender_id == YOUR_BOT_ACCOUNT_ID: continue
-
-                        sender_role = user_roles_per_room[room_id].get(sender_id, 'unknown')
-
-                        print(f"\n--- ルーム {room_id} 新しいメッセージ ---")
-                        print(f"送信者ID: {sender_id}, ロール: {sender_role}")
-                        print(f"本文: {message_body}")
-
-                        # 1. コマンド処理 (`/command OK`, `/command NO`)
-                        if message_body.strip() == "/command OK":
-                            if sender_role == 'admin':
-                                try:
-                                    existing_room = supabase_client.from_("roomid").select("room_id_column").eq("room_id_column", room_id).execute().data
-                                    if not existing_room:
-                                        supabase_client.from_("roomid").insert({"room_id_column": room_id}).execute()
-                                        chatwork_api.post_message(room_id, "[info][title]ボット有効化[/title]この部屋でのボットの監視を有効にしました。[/info]")
-                                        print(f"ルーム {room_id} をSupabaseに追加しました。")
-                                    else:
-                                        chatwork_api.post_message(room_id, "[info][title]既に有効[/title]この部屋は既にボットの監視が有効です。[/info]")
-                                except Exception as e:
-                                    print(f"Supabaseへのルーム有効化でエラー: {e}")
-                                    chatwork_api.post_message(room_id, "[error][title]エラー[/title]ボットの有効化に失敗しました。[/error]")
-                            else:
-                                chatwork_api.post_message(room_id, "[info][title]権限エラー[/title]このコマンドは管理者のみ実行できます。[/info]")
-                            # コマンド処理後は、現在のメッセージでの他の監視はスキップ
-                            continue 
-
-                        elif message_body.strip() == "/command NO":
-                            if sender_role == 'admin':
-                                try:
-                                    supabase_client.from_("roomid").delete().eq("room_id_column", room_id).execute()
-                                    chatwork_api.post_message(room_id, "[info][title]ボット無効化[/title]この部屋でのボットの監視を無効にしました。[/info]")
-                                    print(f"ルーム {room_id} をSupabaseから削除しました。")
-                                except Exception as e:
-                                    print(f"Supabaseからのルーム無効化でエラー: {e}")
-                                    chatwork_api.post_message(room_id, "[error][title]エラー[/title]ボットの無効化に失敗しました。[/error]")
-                            else:
-                                chatwork_api.post_message(room_id, "[info][title]権限エラー[/title]このコマンドは管理者のみ実行できます。[/info]")
-                            # コマンド処理後は、現在のメッセージでの他の監視はスキップ
-                            continue
-
-                        # 2. Supabaseに登録されていない部屋では、以下の監視は行わない
-                        if room_id not in enabled_room_ids:
-                            print(f"ルーム {room_id} はボットが有効化されていません。監視をスキップします。")
-                            continue
-
-                        # 以下は既存の監視ロジック
-                        # ユーザーのアクティビティカウントを初期化または更新
-                        if room_id not in user_activity_counts:
-                            user_activity_counts[room_id] = {}
-                        if sender_id not in user_activity_counts[room_id]:
-                            user_activity_counts[room_id][sender_id] = {'stamps': 0, 'mentions': 0, 'last_reset_time': current_time}
-
-                        # カウントのリセット判定
-                        if (current_time - user_activity_counts[room_id][sender_id]['last_reset_time']) / 3600 >= COUNT_RESET_INTERVAL_HOURS:
-                            print(f"ユーザー {sender_id} のカウントをリセットします。")
-                            user_activity_counts[room_id][sender_id]['stamps'] = 0
-                            user_activity_counts[room_id][sender_id]['mentions'] = 0
-                            user_activity_counts[room_id][sender_id]['last_reset_time'] = current_time
-
-                        # [toall] の検出と権限判定 (メンバーのみ反応)
-                        if "[toall]" in message_body:
-                            if sender_role == 'member': # 管理者は反応しない
-                                print(f"【アクション】メンバー {sender_id} が [toall] を使用しました。権限を閲覧のみに変更します。")
-                                chatwork_api.change_user_permission(room_id, sender_id, 'readonly')
-                                chatwork_api.post_message(room_id, f"[info][title]権限変更通知[/title][To:{sender_id}] さん、[toall] の多用を確認したため、この部屋でのあなたの権限を『閲覧のみ』に変更しました。[/info]")
-                            else:
-                                print(f"【スキップ】管理者 {sender_id} が [toall] を使用しました。")
-                            # [toall] があった場合は、そのメッセージで他のカウントはしない
-                            continue
-
-                        # スタンプ・絵文字の検出とカウント
-                        detected_stamp_emoji_count = count_emoticons_in_message(message_body, ALL_EMOTICONS)
-                        user_activity_counts[room_id][sender_id]['stamps'] += detected_stamp_emoji_count
-                        print(f"スタンプ・絵文字検出: {detected_stamp_emoji_count}個 (累計: {user_activity_counts[room_id][sender_id]['stamps']}個)")
-
-                        if user_activity_counts[room_id][sender_id]['stamps'] >= STAMP_EMOJI_THRESHOLD:
-                            print(f"【アクション】ユーザー {sender_id} のスタンプ・絵文字投稿が閾値({STAMP_EMOJI_THRESHOLD})を超えました。権限を閲覧のみに変更します。")
-                            chatwork_api.change_user_permission(room_id, sender_id, 'readonly')
-                            chatwork_api.post_message(room_id, f"[info][title]権限変更通知[/title][To:{sender_id}] さん、スタンプ・絵文字の多用を確認したため、この部屋でのあなたの権限を『閲覧のみ』に変更しました。[/info]")
-                            # 権限変更したらカウントをリセット
-                            user_activity_counts[room_id][sender_id]['stamps'] = 0
-
-                        # 個人のメンションの検出とカウント (管理者にも適用)
-                        detected_mention_count = count_personal_mentions(message_body)
-                        user_activity_counts[room_id][sender_id]['mentions'] += detected_mention_count
-                        print(f"個人メンション検出: {detected_mention_count}個 (累計: {user_activity_counts[room_id][sender_id]['mentions']}個)")
-
-                        if user_activity_counts[room_id][sender_id]['mentions'] >= MENTION_THRESHOLD:
-                            print(f"【アクション】ユーザー {sender_id} の個人メンションが閾値({MENTION_THRESHOLD})を超えました。権限を閲覧のみに変更します。")
-                            chatwork_api.change_user_permission(room_id, sender_id, 'readonly')
-                            chatwork_api.post_message(room_id, f"[info][title]権限変更通知[/title][To:{sender_id}] さん、個人メンションの多用を確認したため、この部屋でのあなたの権限を『閲覧のみ』に変更しました。[/info]")
-                            # 権限変更したらカウントをリセット
-                            user_activity_counts[room_id][sender_id]['mentions'] = 0
-
-                    # ルームごとの最新メッセージIDを更新
-                    last_message_id_per_room[room_id] = new_messages[-1]['message_id'] if new_messages else current_room_last_message_id # メッセージがない場合は更新しない
+                    logger.error("Supabaseからのルーム無効化でエラー: %s", e)
+                    await chatwork_api.post_message(room_id, "[error][title]エラー[/title]ボットの無効化に失敗しました。[/error]")
+            else:
+                await chatwork_api.post_message(room_id, "[info][title]権限エラー[/title]このコマンドは管理者のみ実行できます。[/info]")
+            # コマンド処理後は、現在のメッセージでの他の監視はスキップ
+            return
+
+        # 2. Supabaseに登録されていない部屋では、以下の監視は行わない
+        if room_id not in _enabled_rooms_cache["set"]:
+            logger.debug("ルーム %s はボットが有効化されていません。監視をスキップします。", room_id)
+            return
+
+        # 以下は既存の監視ロジック
+        # マークアップも顔文字も含まない通常のメッセージは、検出件数が全て0なので走査を省略
+        if not has_markup(message_body):
+            return
+
+        # 顔文字・絵文字・スタンプ・個人メンション・[toall] をまとめて検出
+        if scan is None:
+            scan = (count_emoticons_in_message(message_body), *scan_markup(message_body))
+        detected_emoticon_count, detected_stamp_count, detected_mention_count, has_toall = scan
+
+        # SERVER_SIDE_THRESHOLDS が有効な場合は、集計と閾値判定をSQL関数に任せ、1回のRPCで判定結果だけを受け取る
+        if SERVER_SIDE_THRESHOLDS:
+            detected_stamp_emoji_count = 0 if has_toall else detected_emoticon_count + detected_stamp_count
+            params = {
+                "p_room_id": room_id, "p_account_id": sender_id,
+                "p_stamps": detected_stamp_emoji_count, "p_mentions": detected_mention_count,
+                "p_has_toall": has_toall, "p_sender_role": sender_role,
+                "p_stamp_threshold": STAMP_EMOJI_THRESHOLD, "p_mention_threshold": MENTION_THRESHOLD,
+                "p_window_hours": COUNT_RESET_INTERVAL_HOURS,
+            }
+            try:
+                verdict = (await asyncio.to_thread(retry_db, lambda: supabase_client.rpc("fn_register_message", params).execute())).data
+            except Exception as e:
+                logger.error("fn_register_message の呼び出しに失敗しました: %s", e)
+                return
+            if verdict in SERVER_VERDICT_REASONS:
+                await restrict_user(room_id, sender_id, SERVER_VERDICT_REASONS[verdict])
+            return
+
+        # [toall] の検出と権限判定 (メンバーのみ反応)
+        if has_toall:
+            if sender_role == 'member': # 管理者は反応しない
+                await restrict_user(room_id, sender_id, "[toall] ")
+            else:
+                logger.debug("【スキップ】%s (ロール: %s) が [toall] を使用しました。", sender_id, sender_role)
+            # [toall] があった場合は、そのメッセージで他のカウントはしない
+            return
+
+        # スタンプ・絵文字と個人メンション (管理者にも適用) の検出とカウント (直近 COUNT_RESET_INTERVAL_HOURS 時間のスライディングウィンドウ)
+        detected_stamp_emoji_count = detected_emoticon_count + detected_stamp_count
+        stamps_key = (room_id, sender_id, 'stamps')
+        mentions_key = (room_id, sender_id, 'mentions')
+        stamps_in_window = record_activity(user_activity_events, stamps_key, detected_stamp_emoji_count, current_time, STAMP_EMOJI_THRESHOLD + 1, dirty_activity_keys)
+        mentions_in_window = record_activity(user_activity_events, mentions_key, detected_mention_count, current_time, MENTION_THRESHOLD + 1, dirty_activity_keys)
+        logger.debug("スタンプ・絵文字検出: %s個 (直近%s時間: %s個)", detected_stamp_emoji_count, COUNT_RESET_INTERVAL_HOURS, stamps_in_window)
+        logger.debug("個人メンション検出: %s個 (直近%s時間: %s個)", detected_mention_count, COUNT_RESET_INTERVAL_HOURS, mentions_in_window)
+
+        # 両方の閾値を判定してから、権限変更は1回だけ行う (restrict_user が両方のカウントをリセットする)
+        if stamps_in_window >= STAMP_EMOJI_THRESHOLD:
+            await restrict_user(room_id, sender_id, "スタンプ・絵文字")
+        elif mentions_in_window >= MENTION_THRESHOLD:
+            await restrict_user(room_id, sender_id, "個人メンション")
+        else:
+            if detected_stamp_emoji_count:
+                dirty_activity_keys.add(stamps_key)
+            if detected_mention_count:
+                dirty_activity_keys.add(mentions_key)
+
+    async def poll_room(room_id, current_time):
+        """1ルーム分のメッセージ取得と監視処理。新着メッセージがあった場合はTrueを返す"""
+        if not await refresh_room_members(room_id, current_time):
+            return False # このルームの処理はスキップ
 
+        try:
+            new_messages = await chatwork_api.get_messages(room_id, room_poll_state[room_id].last_id)
         except Exception as e:
-            print(f"致命的なエラーが発生しました: {e}")
-            # 広範なエラー発生時は、少し長めに待機して再試行
-            time.sleep(POLLING_INTERVAL_SECONDS * 2) 
-
-        time.sleep(POLLING_INTERVAL_SECONDS) # 設定されたポーリング間隔で待機
+            logger.error("ルーム %s のメッセージ取得に失敗しました: %s", room_id, e)
+            return False # このルームの処理はスキップ
+
+        if new_messages:
+            # 複数件まとめて取得した場合は、本文を連結して一括で走査する
+            scans = scan_messages([message['body'] for message in new_messages]) if len(new_messages) > 1 else [None]
+            for message, scan in zip(new_messages, scans):
+                await handle_message(room_id, message, current_time, scan)
+
+            # ルームごとの最新メッセージIDを更新
+            room_poll_state[room_id].last_id = new_messages[-1]['message_id']
+            dirty_room_ids.add(room_id)
+
+        return bool(new_messages)
+
+    async def handle_webhook_message(event):
+        """Webhookで受け取ったmessage_createdイベントを処理"""
+        room_id = int(event['room_id'])
+        # ポーリングで監視しているルームのイベントまで処理すると二重にカウントされるため、Webhook設定済みのルームのみ処理する
+        if room_id not in WEBHOOK_ROOM_IDS:
+            logger.debug("Webhook対象外のルーム %s のWebhookイベントを無視しました。", room_id)
+            return
+        current_time = time.time()
+        if not await refresh_room_members(room_id, current_time):
+            return
+        await handle_message(room_id, event, current_time)
+
+    logger.info("Chatwork Botを開始します...")
+
+    # RenderなどはSIGTERMで停止するため、SIGINTと同様にメインタスクをキャンセルして終了処理 (状態の最終保存) を行う
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    persist_task = asyncio.create_task(persist_state_periodically())
+    webhook_server = None
+    if WEBHOOK_ROOM_IDS:
+        webhook_server = uvicorn.Server(uvicorn.Config(create_webhook_app(handle_webhook_message), host="0.0.0.0", port=WEBHOOK_PORT, log_level="warning"))
+        webhook_task = asyncio.create_task(webhook_server.serve())
+        logger.info("Webhookの受信をポート %s で開始しました。", WEBHOOK_PORT)
+    try:
+        while True:
+            try:
+                current_time = time.time()
+
+                # ボットが反応すべきルームIDの一覧は、キャッシュの有効期限が切れた場合のみ再取得
+                if current_time - _enabled_rooms_cache["ts"] > ENABLED_ROOMS_CACHE_TTL_SECONDS:
+                    await refresh_enabled_rooms(supabase_client, current_time)
+
+                # ポーリング時刻に達したルームを同一イベントループ上で並行してポーリング
+                due_room_ids = [room_id for room_id in polling_room_ids if room_poll_state[room_id].next_poll <= current_time]
+                results = await asyncio.gather(*[poll_room(room_id, current_time) for room_id in due_room_ids], return_exceptions=True)
+                for room_id, result in zip(due_room_ids, results):
+                    if isinstance(result, Exception):
+                        logger.error("ルーム %s の処理中にエラーが発生しました: %s", room_id, result)
+                    # 新着があれば通常間隔に戻し、なければ上限まで1.5倍ずつ間隔を延ばす
+                    state = room_poll_state[room_id]
+                    if result is True:
+                        state.backoff = POLLING_INTERVAL_SECONDS
+                    else:
+                        state.backoff = min(state.backoff * 1.5, IDLE_POLLING_MAX_SECONDS)
+                    state.next_poll = current_time + state.backoff
+
+            except Exception as e:
+                logger.error("致命的なエラーが発生しました: %s", e)
+                # 広範なエラー発生時は、少し長めに待機して再試行
+                await asyncio.sleep(POLLING_INTERVAL_SECONDS * 2) 
+
+            # 次にポーリング時刻を迎えるルームまで待機
+            if room_poll_state:
+                next_poll = min(state.next_poll for state in room_poll_state.values())
+                await asyncio.sleep(max(next_poll - time.time(), 0))
+            else:
+                await asyncio.sleep(POLLING_INTERVAL_SECONDS)
+    finally:
+        if webhook_server is not None:
+            webhook_server.should_exit = True
+            await webhook_task
+        persist_task.cancel()
+        await flush_state()
+        await chatwork_api.close()
 
 if __name__ == "__main__":
-    run_bot()
+    log_listener = setup_logging()
+    log_listener.start()
+    try:
+        asyncio.run(run_bot())
+    except asyncio.CancelledError:
+        logger.info("SIGTERMを受け取ったため、ボットを終了しました。")
+    finally:
+        log_listener.stop()
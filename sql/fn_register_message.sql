@@ -0,0 +1,76 @@
+-- SERVER_SIDE_THRESHOLDS=true の場合に使用する、アクティビティの集計と閾値判定を行うSQL関数
+-- SupabaseダッシュボードのSQL Editorで実行してください。
+
+create table if not exists activity_log (
+    room_id bigint not null,
+    account_id bigint not null,
+    stamps integer not null default 0,
+    mentions integer not null default 0,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists activity_log_room_account_created_at_idx
+    on activity_log (room_id, account_id, created_at);
+
+-- 集計期間を過ぎた行を全ユーザー分まとめて削除するためのインデックス
+create index if not exists activity_log_created_at_idx
+    on activity_log (created_at);
+
+-- anonキーなどからPostgREST経由で読み書きされないよう、RLSを有効にする (ポリシーは作成しない)
+-- ボットはService Role Keyで接続するため、RLSの影響を受けない
+alter table activity_log enable row level security;
+
+-- 1件のメッセージの検出結果を記録し、行うべきアクションを返す
+--   'toall'    : メンバーが [toall] を使用した
+--   'stamps'   : 直近 p_window_hours 時間のスタンプ・絵文字数が閾値に達した
+--   'mentions' : 直近 p_window_hours 時間の個人メンション数が閾値に達した
+--   'ok'       : アクション不要
+-- 'stamps' / 'mentions' を返す場合は、そのユーザーのカウントをまとめてリセットする
+create or replace function fn_register_message(
+    p_room_id bigint,
+    p_account_id bigint,
+    p_stamps integer,
+    p_mentions integer,
+    p_has_toall boolean,
+    p_sender_role text,
+    p_stamp_threshold integer,
+    p_mention_threshold integer,
+    p_window_hours integer
+) returns text
+language plpgsql
+as $$
+declare
+    v_stamps integer;
+    v_mentions integer;
+begin
+    -- [toall] があった場合は、そのメッセージで他のカウントはしない (管理者は反応しない)
+    if p_has_toall then
+        return case when p_sender_role = 'member' then 'toall' else 'ok' end;
+    end if;
+
+    -- 一度だけ投稿して以降投稿しないユーザーの行も残らないよう、集計期間を過ぎた行は全ユーザー分削除する
+    delete from activity_log
+    where created_at < now() - make_interval(hours => p_window_hours);
+
+    if p_stamps > 0 or p_mentions > 0 then
+        insert into activity_log (room_id, account_id, stamps, mentions)
+        values (p_room_id, p_account_id, p_stamps, p_mentions);
+    end if;
+
+    select coalesce(sum(stamps), 0), coalesce(sum(mentions), 0)
+    into v_stamps, v_mentions
+    from activity_log
+    where room_id = p_room_id and account_id = p_account_id;
+
+    if v_stamps >= p_stamp_threshold or v_mentions >= p_mention_threshold then
+        delete from activity_log where room_id = p_room_id and account_id = p_account_id;
+        return case when v_stamps >= p_stamp_threshold then 'stamps' else 'mentions' end;
+    end if;
+
+    return 'ok';
+end;
+$$;
+
+-- 既定では誰でも関数を実行できるため、anon / authenticated からの実行権限を取り消し、ボットが使う service_role のみに許可する
+revoke execute on function fn_register_message(bigint, bigint, integer, integer, boolean, text, integer, integer, integer) from public, anon, authenticated;
+grant execute on function fn_register_message(bigint, bigint, integer, integer, boolean, text, integer, integer, integer) to service_role;